@@ -3,8 +3,8 @@
 import numpy as np
 from numpy import pi
 import matplotlib.pyplot as plt
-from scipy.linalg import expm
-from functions import transfer_to_scattering, transport_checks, thermal_average, finite_voltage_bias
+from functions import transfer_to_scattering, transport_checks, thermal_average, finite_voltage_bias, \
+    build_M, transfer_sweep
 
 
 #%% Parameters
@@ -28,6 +28,7 @@ n_modes = int(len(modes))                      # Number of l modes
 n_s = 2                                        # Spin components
 G = np.zeros((len(E_F), ))                     # Conductance vector
 G_an = np.zeros((len(E_F), ))                  # Analytical conductance vector
+n_batch = 100                                  # Fermi energies per batch of transfer matrices
 L_grid = 1000
 dx = L / L_grid
 
@@ -58,22 +59,21 @@ print(bias_interval, sample_points_bias)
 #%% Transport calculation
 
 # Zero-temperature and zero-bias calculation
-M_spin2 = sigma_x                                # Exponent of the spin transfer matrix
-M_modes1 = np.eye(n_modes)                       # Exponent of the mode transfer matrix
-M_modes2 = (2 * pi / P) * np.diag(modes - 0.5)   # Exponent of the mode transfer matrix
-for i, energy in enumerate(E_F):
-
-    print(str(i) + "/" + str(len(E_F)))
-    M_spin1 = 1j * (energy / vf) * sigma_z                            # Exponent of the spin transfer matrix                                # Exponent of the mode transfer matrix
-    M_tot = np.kron(M_spin1, M_modes1) + np.kron(M_spin2, M_modes2)   # Exponent of the transfer matrix
+M_0 = np.zeros((2 * n_modes, 2 * n_modes), dtype=complex)  # Exponent of the transfer matrix at E = 0
+ax = np.zeros((n_modes, n_modes))                          # The clean wire has no eA_x mode mixing
+build_M(modes, L, P / (2 * pi), 0, 0, vf, 0, ax, False, M_0)
+for batch in np.array_split(np.arange(len(E_F)), -(-len(E_F) // n_batch)):
 
     # Quick transport calculation particular for the clean wire
-    transfer_matrix = expm(M_tot * L)                                 # Transfer matrix
-    scat_matrix = transfer_to_scattering(transfer_matrix, n_modes)    # Scattering matrix
+    transfer_matrices = transfer_sweep(M_0, E_F[batch], L / vf, n_modes)  # Transfer matrices of the batch
+    for i, transfer_matrix in zip(batch, transfer_matrices):
+
+        print(str(i) + "/" + str(len(E_F)))
+        scat_matrix = transfer_to_scattering(transfer_matrix, n_modes)    # Scattering matrix
 
-    t = scat_matrix[n_modes:, 0: n_modes]                             # Transmission matrix
-    t_dagger = np.conj(t.T)                                           # Conjugate transmission matrix
-    G[i] = np.trace(t_dagger @ t)                                     # Conductance
+        # scat_matrix.T is the transmission block of ScatBlocks, not a numpy transpose
+        t = scat_matrix.T                                                 # Transmission matrix
+        G[i] = np.linalg.norm(t, 'fro') ** 2                              # Conductance, Tr(t^\dagger t)
 
 
 # Analytical expression (see Quantum-limited shot noise in graphene paper)
@@ -5,8 +5,9 @@ from numpy import pi
 import os
 import matplotlib.pyplot as plt
 import h5py
-from scipy.linalg import expm
-from functions import transfer_to_scattering, scat_product, transport_checks, thermal_average, finite_voltage_bias
+from functions import transfer_to_scattering, scat_product, transport_checks, thermal_average, finite_voltage_bias, \
+    build_M, expm_block, ax_matrix, pair_steps, scat_power, scat_empty, scat_copy, \
+    constriction_regions, constriction_profile
 
 
 #%% Parameters
@@ -36,40 +37,6 @@ L = x5 - x0                        # Length of the nanowire in nm
 slope_w = (w2 - w1) / (x2 - x1)    # Slope of the width
 slope_h = (h2 - h1) / (x2 - x1)    # Slope of the height
 slope_a = (a2 - a1) / (x2 - x1)    # Slope of the radius
-def height(x):
-    if x0 <= x < x1 or x4 < x <= x5:
-        return h1
-    if x1 <= x <= x2:
-        return h1 + slope_h * (x - x1)
-    if x3 <= x <= x4:
-        return h2 - slope_h * (x - x3)
-    if x2 < x < x3:
-        return h2
-def width(x):
-    if x0 <= x < x1 or x4 < x <= x5:
-        return w1
-    if x1 <= x <= x2:
-        return w1 + slope_w * (x - x1)
-    if x3 <= x <= x4:
-        return w2 - slope_w * (x - x3)
-    if x2 < x < x3:
-        return w2
-def radius(x):
-    if x0 <= x < x1 or x4 < x <= x5:
-        return a1
-    if x1 <= x <= x2:
-        return a1 + slope_a * (x - x1)
-    if x3 <= x <= x4:
-        return a2 - slope_a * (x - x3)
-    if x2 < x < x3:
-        return a2
-def slope(x):
-    if x0 <= x < x1 or x4 < x <= x5:
-        return 0
-    if (x1 <= x <= x2) or (x3 <= x <= x4):
-        return slope_a
-    elif x2 < x < x3:
-        return 0
 
 # Declarations
 l_cutoff = 50                                      # Cutoff for the number of angular momentum modes that we consider
@@ -78,10 +45,17 @@ n_modes = int(len(modes))                          # Number of l modes
 n_s = 2                                            # Spin components
 n_x = 300                                          # Number of x intervals
 L_grid = np.linspace(x0, x5, n_x)                  # Grid for x direction
+regions = constriction_regions(L_grid, x1, x2, x3, x4)  # Cones and constriction along the grid
 dx = L / n_x                                       # Transfer step
 aux1 = 0.5 * 1e16 * e * B_par                      # Auxiliary amplitude for the parallel vector potential
 aux2 = 1e16 * e * B_perp                           # Auxiliary amplitude for the perpendicular vector potential
 G = np.zeros((len(E_F), ))                         # Conductance vector
+precision = (np.complex128, )                      # Working precisions, (np.complex64, np.complex128) tries single first
+tol_precision = 1e-4                               # Unitarity tolerance before falling back to the next precision
+# Merging cone steps in pairs at their midpoint is an approximation (O(dx^3) error per merged pair), not the exact
+# product of the two steps, so results with tol_pair >= 0 are not equivalent to the step by step calculation.
+# The default -1 is a sentinel that disables the merging and keeps the exact path.
+tol_pair = -1                                      # Max slope change between cone steps merged in pairs (< 0 disables)
 
 # We use 1e16 cause T nm = nm/m² so we need 1/1e18, and we need to divide by hbar because we are pulling a factor
 # hbar over all but the minimal coupling says p --> p+eA, so to pull the hbar factor out we need to write
@@ -126,52 +100,53 @@ for file in os.listdir(outdir):
 #%% Transport calculation at 0K and Vb=0 meV
 
 if calculate_G == 1:
-    M_modes1 = np.eye(n_modes)                       # Exponent of the mode transfer matrix for the Ef term
-    M_modes2 = np.diag(modes - 0.5)                  # Exponent of the mode transfer matrix for the p_y term
-    M1_aux = (1j / vf) * np.kron(sigma_z, M_modes1)  # Exponent of the transfer matrix for the Ef term (wo Ef)
-    M2_aux = np.kron(sigma_x, M_modes2)              # Exponent of the transfer matrix for the p_y term (wo 1/a)
-    M3_aux = aux1 * np.kron(sigma_x, M_modes1)       # Exponent of the transfer matrix for the eA_y term (wo a)
-    # Mode mixing matrix for eA_x
-    def M_offdiag(x):
-
-        M_eA = np.zeros([n_modes, n_modes], )  # Mode mixing matrix for the vector potential
-        r = width(x) / (width(x) + height(x))  # Aspect ratio at point x in the geometry
-        P = 2 * (width(x) + height(x))         # Perimeter at point x in the geometry
-
-        for i, n1 in enumerate(modes):
-            for j, n2 in enumerate(modes):
-
-                if (n1 - n2) % 2 != 0:
-                    m = n1 - n2
-                    M_eA[i, j] = aux2 * P * vf * ((-1) ** ((m + 1) / 2)) * np.sin(m * pi * r / 2) / (m * m * pi * pi)
-
-        return M_eA
+    M = {dtype: np.zeros((2 * n_modes, 2 * n_modes), dtype=dtype) for dtype in precision}
+    # Exponent of the transfer matrix in each precision (entries set in place)
+    S_dx = {dtype: scat_empty(n_modes, dtype) for dtype in precision}  # Step scattering matrix
+    S = {dtype: scat_empty(n_modes, dtype) for dtype in precision}     # Accumulated one
+    w_grid = constriction_profile(L_grid, regions, x1, x3, w1, w2, slope_w)  # Width along the grid
+    h_grid = constriction_profile(L_grid, regions, x1, x3, h1, h2, slope_h)  # Height along the grid
+    r_grid = constriction_profile(L_grid, regions, x1, x3, a1, a2, slope_a)  # Radius along the grid
+    dr_grid = np.where(regions[0] | regions[2], slope_a, 0.)                  # Slope of the radius along the grid
+    dx_grid, dr_grid, (w_grid, h_grid, r_grid) = pair_steps(dx, dr_grid, (w_grid, h_grid, r_grid), tol_pair)
+    n_steps = len(dx_grid)                                   # Number of transfer steps after merging cone pairs
+    ax_grid = [ax_matrix(modes, w_x / (w_x + h_x), aux2 * 2 * (w_x + h_x)) for w_x, h_x in zip(w_grid, h_grid)]
+    # eA_x mode mixing along the grid, cached so uniform regions share a single matrix
+    update_ax = np.ones((n_steps, ), dtype=bool)             # Rebuild eA_x only where the cross-section changes
+    update_ax[1:] = (np.diff(w_grid) != 0) | (np.diff(h_grid) != 0) | (np.diff(dx_grid) != 0)
+    new_step = update_ax.copy()                              # Steps whose exponent differs from the previous one
+    new_step[1:] |= (np.diff(r_grid) != 0) | (np.diff(dr_grid) != 0)
+    step_start = np.flatnonzero(new_step)                    # First step of each run of identical steps
+    step_count = np.diff(np.append(step_start, n_steps))     # Number of identical steps in each run
 
     # Sweep the Fermi level
     for i, fermi_level in enumerate(E_F):
 
         print(str(i) + "/" + str(len(E_F)-1))
 
-        # Propagation of the scattering matrix
-        for j, x in enumerate(L_grid):
+        # Propagation of the scattering matrix, repeated in the next precision if the result is not unitary
+        for dtype in precision:
+            for k, j in enumerate(step_start):
+
+                build_M(modes, dx_grid[j], r_grid[j], dr_grid[j], fermi_level, vf, aux1, ax_grid[j], update_ax[j],
+                        M[dtype])  # Exponent of the transfer matrix
+                transfer_matrix = expm_block(M[dtype], n_modes)                               # Transfer matrix
+                scat_matrix_dx = transfer_to_scattering(transfer_matrix, n_modes, S_dx[dtype])  # Scattering matrix for dx
+                scat_matrix_run = scat_power(scat_matrix_dx, step_count[k], n_modes)          # Run of identical steps
 
-            M1 = fermi_level * np.sqrt(1 + slope(x) ** 2) * M1_aux  # Exponent of the transfer matrix for the Ef term
-            M2 = M2_aux * np.sqrt(1 + slope(x) ** 2) / radius(x)    # Exponent of the transfer matrix for the p_y term
-            M3 = M3_aux * radius(x) * np.sqrt(1 + slope(x) ** 2)    # Exponent of the transfer matrix for the eA_x term
-            M4 = (-1j / vf) * np.kron(sigma_0, M_offdiag(x))        # Exponent of the transfer matrix for the eA_y term
-            M = M1 + M2 + M3 + M4                                   # Exponent of the transfer matrix
-            transfer_matrix = expm(M * dx)                          # Transfer matrix
+                if k == 0:
+                    scat_matrix = scat_copy(scat_matrix_run, S[dtype])                # Initial scattering matrix
+                else:
+                    scat_product(scat_matrix, scat_matrix_run, n_modes, scat_matrix)  # Propagating the scattering matrix
 
-            if j == 0:
-                scat_matrix = transfer_to_scattering(transfer_matrix, n_modes)     # Initial scattering matrix
-            else:
-                scat_matrix_dx = transfer_to_scattering(transfer_matrix, n_modes)  # Scattering matrix for dx
-                scat_matrix = scat_product(scat_matrix, scat_matrix_dx, n_modes)   # Propagating the scattering matrix
+            if dtype == precision[-1] or \
+                    transport_checks(n_modes, scat_matrix=scat_matrix, tol=tol_precision, verbose=False):
+                break
 
 
-        t = scat_matrix[n_modes:, 0: n_modes]      # Transmission matrix
-        t_dagger = np.conj(t.T)                    # Conjugate transmission matrix
-        G[i] = np.trace(t_dagger @ t)              # Conductance / Gq
+        # scat_matrix.T is the transmission block of ScatBlocks, not a numpy transpose
+        t = scat_matrix.T                          # Transmission matrix
+        G[i] = np.linalg.norm(t, 'fro') ** 2       # Conductance / Gq, Tr(t^\dagger t)
         print(G[i])
 
 
@@ -5,8 +5,8 @@ from numpy import pi
 import time
 import matplotlib.pyplot as plt
 from numpy.linalg import inv
-from scipy.linalg import block_diag, expm
-from functions import transfer_to_scattering, scat_product, transport_checks
+from scipy.linalg import block_diag
+from functions import transfer_to_scattering, scat_product, transport_checks, build_M, expm_block, ax_matrix
 
 
 #%% Parameters
@@ -72,46 +72,21 @@ plt.show()
 
 #%% Transport calculation
 
-factor1 = 1j * np.sqrt(1 + slope_a ** 2) / vf    # Coefficient of the exponent of the transfer matrix for the Ef term
-factor2 = np.sqrt(1 + slope_a ** 2)              # Coefficient of the exponent of the transfer matrix for the p_y term
-factor3 = np.sqrt(1 + slope_a ** 2) * aux1       # Coefficient of the exponent of the transfer matrix for the eA_y term
-factor4 = -1j / vf                               # Coefficient of the exponent of the transfer matrix for the eA_x term
-M_modes1 = np.eye(n_modes)                       # Exponent of the mode transfer matrix for the Ef term
-M_modes2 = np.diag(modes - 0.5)                  # Exponent of the mode transfer matrix for the p_y term
-M1_aux = factor1 * np.kron(sigma_z, M_modes1)    # Exponent of the transfer matrix for the Ef term (wo Ef)
-M2_aux = factor2 * np.kron(sigma_x, M_modes2)    # Exponent of the transfer matrix for the p_y term (wo 1/a)
-M3_aux = factor3 * np.kron(sigma_x, M_modes1)    # Exponent of the transfer matrix for the eA_y term (wo a)
-# Mode mixing matrix for eA_x
-def M_offdiag(x):
-
-    M_eA = np.zeros([n_modes, n_modes], )  # Mode mixing matrix for the vector potential
-    r = width(x) / (width(x) + height(x))  # Aspect ratio at point x in the geometry
-    P = 2 * (width(x) + height(x))         # Perimeter at point x in the geometry
-
-    for i, n1 in enumerate(modes):
-        for j, n2 in enumerate(modes):
-
-            if (n1 - n2) % 2 != 0:
-                m = n1 - n2
-                M_eA[i, j] = aux2 * P * vf * ((-1) ** ((m + 1) / 2)) * np.sin(m * pi * r / 2) / (m * m * pi * pi)
-
-    return M_eA
-
+M = np.zeros((2 * n_modes, 2 * n_modes), dtype=complex)  # Exponent of the transfer matrix (entries set in place)
+w_grid, h_grid, r_grid = width(L_grid), height(L_grid), radius(L_grid)  # Geometry along the grid
+ax_grid = [ax_matrix(modes, w_x / (w_x + h_x), aux2 * 2 * (w_x + h_x)) for w_x, h_x in zip(w_grid, h_grid)]
+# eA_x mode mixing along the grid, computed once for all energies
 
 # Sweep the Fermi level
 for i, fermi_level in enumerate(E_F):
 
     print(str(i) + "/" + str(len(E_F)-1))
-    M1 = fermi_level * M1_aux                           # Exponent of the transfer matrix for the Ef term
 
     # Propagation of the scattering matrix
-    for j, x in enumerate(L_grid):
+    for j in range(n_x):
 
-        M2 = M2_aux / radius(x)                         # Exponent of the transfer matrix for the p_y term
-        M3 = M3_aux * radius(x)                         # Exponent of the transfer matrix for the eA_x term
-        M4 = factor4 * np.kron(sigma_0, M_offdiag(x))   # Exponent of the transfer matrix for the eA_y term
-        M = M1 + M2 + M3 + M4                           # Exponent of the transfer matrix
-        transfer_matrix = expm(M * dx)                  # Transfer matrix
+        build_M(modes, dx, r_grid[j], slope_a, fermi_level, vf, aux1, ax_grid[j], True, M)  # Exponent
+        transfer_matrix = expm_block(M, n_modes)            # Transfer matrix
 
         if j == 0:
             scat_matrix = transfer_to_scattering(transfer_matrix, n_modes)     # Initial scattering matrix
@@ -120,9 +95,9 @@ for i, fermi_level in enumerate(E_F):
             scat_matrix = scat_product(scat_matrix, scat_matrix_dx, n_modes)   # Propagating the scattering matrix
 
 
-    t = scat_matrix[n_modes:, 0: n_modes]      # Transmission matrix
-    t_dagger = np.conj(t.T)                    # Conjugate transmission matrix
-    G[i] = np.trace(t_dagger @ t)              # Conductance / Gq
+    # scat_matrix.T is the transmission block of ScatBlocks, not a numpy transpose
+    t = scat_matrix.T                          # Transmission matrix
+    G[i] = np.linalg.norm(t, 'fro') ** 2       # Conductance / Gq, Tr(t^\dagger t)
     print(G[i])
 
 
@@ -4,8 +4,8 @@ import numpy as np
 from numpy import pi
 import matplotlib.pyplot as plt
 from numpy.linalg import inv
-from scipy.linalg import expm
-from functions import transfer_to_scattering, scat_product, transport_checks, thermal_average, finite_voltage_bias
+from functions import transport_checks, thermal_average, finite_voltage_bias, \
+    bands_nw, build_M, ax_matrix, uniform_scattering, transfer_sweep
 
 
 #%% Parameters
@@ -34,8 +34,7 @@ P = (2 * w) + (2 * h)                              # Perimeter of the wire
 r = w / (w + h)                                    # Useful parameter to define the vector potential
 aux = 1e16 * hbar * vf * e * B * P                 # Auxiliary amplitude for the vector potential
 G = np.empty([len(E_F), ])                         # Conductance vector
-M_offdiag = np.zeros([n_modes, n_modes], )         # Mode mixing matrix for the vector potential
-energy_bands = np.empty([n_modes * n_s, n_k], )          # Energy bands
+n_batch = 100                                      # Fermi energies per batch of transfer matrices
 
 # For aux we use 1e16 cause T nm = nm/m² so we need 1/1e18, and we need to divide by hbar because we are pulling a factor
 # hbar over all but the minimal coupling says p --> p+eA, so to pull the hbar factor out we need to write
@@ -67,49 +66,34 @@ print(bias_interval, sample_points_bias)
 #%% Transfer matrix calculation
 
 # Mode mixing matrix for eA
-for i, n1 in enumerate(modes):
-    for j, n2 in enumerate(modes):
-
-        if (n1 - n2) % 2 != 0:
-            m = n1 - n2
-            M_offdiag[i, j] = aux * ((-1) ** ((m + 1) / 2)) * np.sin(m * pi * r / 2) / (m * m * pi * pi)
+M_offdiag = ax_matrix(modes, r, aux)
 
 
 # Band structure calculation
 aux_l = (hbar * vf * 2 * pi / P) * (modes - (1/2))   # sigma_y component, with different l for each mode
 ham_y = np.kron(np.diag(aux_l), sigma_y)             # Proper sigma_y diag matrix in the tensor product basis
 ham_offdiag = np.kron(M_offdiag, sigma_x)            # Proper sigma_x off-diag matrix in the tensor product basis
-for i, k in enumerate(k_vec):
-
-    aux_k = ((hbar * vf) * k).repeat(n_modes)       # sigma_x component with same k for each block
-    ham_x = np.kron(np.diag(aux_k), sigma_x)        # Proper sigma_x  diag matrix in the tensor product basis
-    Hamiltonian = ham_x + ham_y + ham_offdiag       # H(k) in the tensor product basis
-    energy_bands[:, i] = np.linalg.eigvalsh(Hamiltonian)  # Eigenenergies E(k)
-    idx = energy_bands[:, i].argsort()                    # Ordering the energy bands at k
-    energy_bands[:, i] = energy_bands[idx, i]                   # Ordered energy bands
+energy_bands = bands_nw(ham_y + ham_offdiag, k_vec, hbar * vf)  # Ordered energy bands E(k)
 
 
 #%% Transport calculation
-M_spin2 = sigma_x                                # Exponent of the spin transfer matrix
-M_modes1 = np.eye(n_modes)                       # Exponent of the mode transfer matrix
-M_modes2 = (2 * pi / P) * np.diag(modes - 0.5)   # Exponent of the mode transfer matrix
-for i, fermi_level in enumerate(E_F):
-
-    print(str(i) + "/" + str(len(E_F)-1))
-    M_spin1 = 1j * (fermi_level / vf) * sigma_z                          # Exponent of the spin transfer matrix
-    M_diag = np.kron(M_spin1, M_modes1) + np.kron(M_spin2, M_modes2)     # Exponent of the diagonal transfer matrix
-    M = M_diag - 1j * np.kron(sigma_0, M_offdiag / vf)                   # Exponent of the transfer matrix
-
-    transfer_matrix = expm(M * dx)                                       # Transfer matrix
-    scat_matrix0 = transfer_to_scattering(transfer_matrix, n_modes)      # Scattering matrix
-    scat_matrix = scat_matrix0                                           # Scattering matrix
-
-    for pos in range(L_grid):
-        scat_matrix = scat_product(scat_matrix, scat_matrix0, n_modes)   # Propagating the scattering matrix
-
-    t = scat_matrix[n_modes:, 0: n_modes]                                # Transmission matrix
-    t_dagger = np.conj(t.T)                                              # Conjugate transmission matrix
-    G[i] = np.trace(t_dagger @ t)                                        # Conductance / Gq
+M_0 = np.zeros((2 * n_modes, 2 * n_modes), dtype=complex)  # Exponent of the transfer matrix at E = 0
+ax = M_offdiag / (hbar * vf)                               # Mode mixing in the exponent of the transfer matrix
+build_M(modes, dx, P / (2 * pi), 0, 0, vf, 0, ax, True, M_0)
+
+# With B_perp != 0, ax mixes the modes and transfer_sweep falls back to a full expm at every energy, so the batching
+# gives no speedup here, it only saves the exponentials when B_perp = 0
+for batch in np.array_split(np.arange(len(E_F)), -(-len(E_F) // n_batch)):
+
+    transfer_matrices = transfer_sweep(M_0, E_F[batch], dx / vf, n_modes)  # Transfer matrices of the batch
+    for i, transfer_matrix in zip(batch, transfer_matrices):
+
+        print(str(i) + "/" + str(len(E_F)-1))
+        scat_matrix = uniform_scattering(transfer_matrix, L_grid + 1, n_modes)  # Scattering matrix of the whole wire
+
+        # scat_matrix.T is the transmission block of ScatBlocks, not a numpy transpose
+        t = scat_matrix.T                                                    # Transmission matrix
+        G[i] = np.linalg.norm(t, 'fro') ** 2                                 # Conductance / Gq, Tr(t^\dagger t)
 
 
 #%% Low temperature thermal average of the conductance
@@ -5,7 +5,7 @@ import time
 import matplotlib.pyplot as plt
 from scipy.linalg import block_diag
 
-from functions import Conductance
+from functions import Conductance, bands_nw, ax_matrix
 # %% Rectangular nanowire with perpendicular magnetic field
 
 
@@ -31,8 +31,6 @@ modes = np.arange(-l_cutoff, l_cutoff+1)        # Angular momentum modes
 n_k = int(len(k))                               # Number of k modes
 n_modes = int(len(modes))                       # Number of l modes
 n_s = 2                                         # Spin components
-energy = np.zeros((int(n_modes * n_s), n_k))    # Energy matrix declaration
-off_diag = np.zeros((n_modes, n_modes))         # Off diag auxiliary matrix declaration
 conductance = np.zeros((len(V_bias), len(Vg)))  # Conductance matrix declaration
 
 # Pauli matrices
@@ -44,27 +42,16 @@ sigma_y = np.array([[0, -1j], [1j, 0]])  # Pauli y
 
 # Hamiltonian and energy eigenvalues
 # Off diagonal elements (coupling between angular momentum modes)
-for index1 in range(n_modes):
-    for index2 in range(n_modes):
-        if (modes[index1] - modes[index2]) % 2 != 0:
-            m = modes[index1] - modes[index2]
-            off_diag[index1, index2] = 1e16 * hbar * vf * e * B * P * ((-1) ** ((m + 1) / 2)) * \
-                                          np.sin(m * pi * r / 2) / (m * m * pi * pi)
-            # 1e16 cause T nm = nm/m² so we need 1/1e18 and we need to divide by hbar cause we are pulling a factor
-            # hbar over all but the minimal coupling says p --> p+eA, so to pull the hbar factor out we need to write
-            # eA/hbar so an added 1e34
+off_diag = ax_matrix(modes, r, 1e16 * hbar * vf * e * B * P)
+# 1e16 cause T nm = nm/m² so we need 1/1e18 and we need to divide by hbar cause we are pulling a factor
+# hbar over all but the minimal coupling says p --> p+eA, so to pull the hbar factor out we need to write
+# eA/hbar so an added 1e34
 
 aux_l = (hbar * vf * 2 * pi / P) * (modes - (1/2))  # sigma_y component, with different l for each mode
 ham_y = np.kron(np.diag(aux_l), sigma_y)            # Proper sigma_y diag matrix in the tensor product basis
 ham_offdiag = np.kron(off_diag, sigma_x)            # Proper sigma_x off-diag matrix in the tensor product basis
 
-for index in range(n_k):
-    aux_k = ((hbar * vf) * k[index]).repeat(n_modes)    # sigma_x component with same k for each block
-    ham_x = np.kron(np.diag(aux_k), sigma_x)            # Proper sigma_x  diag matrix in the tensor product basis
-    Hamiltonian = ham_x + ham_y + ham_offdiag           # H(k) in the tensor product basis
-    energy[:, index] = np.linalg.eigvalsh(Hamiltonian)  # Eigenenergies E(k)
-    idx = energy[:, index].argsort()                    # Ordering the energy bands at k
-    energy[:, index] = energy[idx, index]               # Ordered energy bands
+energy = bands_nw(ham_y + ham_offdiag, k, hbar * vf)  # Ordered energy bands E(k)
 
 # # Conductance (mode-counting approximation)
 # for index1 in range(len(V_bias)):
@@ -1,6 +1,14 @@
 # Function file for the TI constriction project
 import numpy as np
+from numpy import pi
+from functools import lru_cache
+from collections import namedtuple
 from numpy.linalg import inv
+from scipy.linalg import expm
+from numba import njit, prange
+
+# Scattering matrix [[r, t'], [t, r']] stored as its four contiguous (n_modes, n_modes) blocks
+ScatBlocks = namedtuple('ScatBlocks', ['R', 'Tp', 'T', 'Rp'])
 
 def f_FD(E, mu, T):
 
@@ -24,71 +32,420 @@ def df_FD(E, mu, T):
     else:
         raise ValueError("T=0 limit undefined unless inside an integral!")
 
-def transfer_to_scattering(transfer_matrix, n_modes):
+def transfer_to_scattering(transfer_matrix, n_modes, out=None):
 
     # Transform from the transfer matrix to the scattering matrix
     # transfer_matrix: Transfer matrix to translate to scattering
     # n_modes: Number of modes contributing to transport (N_states/2 because spin momentum locking)
+    # out: Optional preallocated ScatBlocks for the scattering matrix
+    # Returns the scattering matrix as ScatBlocks
 
     inv_T = transfer_matrix[0: n_modes, 0: n_modes]  # t^\dagger ^(-1)
     inv_Tp = transfer_matrix[n_modes:, n_modes:]     # t' ^(-1)
     inv_R = transfer_matrix[n_modes:, 0: n_modes]    # -t'^(-1) r
     inv_Rp = transfer_matrix[0: n_modes, n_modes:]   # r't'^(-1)
 
-    T = np.conj(inv(inv_T)).T  # t
-    Tp = inv(inv_Tp)           # t'
-    R = - Tp @ inv_R           # r
-    Rp = inv_Rp @ Tp           # r'
-
-    scat_matrix = np.block([[R, Tp], [T, Rp]])  # scattering matrix
+    if out is None:
+        out = scat_empty(n_modes, transfer_matrix.dtype)
+    # out.T is the transmission block of ScatBlocks, only the trailing .T of np.conj(inv(...)) is a transpose
+    out.T[:] = np.conj(inv(inv_T)).T        # t = (t^\dagger ^(-1))^\dagger ^(-1)
+    out.Tp[:] = inv(inv_Tp)                 # t'
+    np.matmul(out.Tp, inv_R, out=out.R)     # - r
+    np.negative(out.R, out=out.R)           # r
+    np.matmul(inv_Rp, out.Tp, out=out.Rp)   # r'
 
-    return scat_matrix
+    return out
 
-def scat_product(s1, s2, n_modes):
+def scat_product(s1, s2, n_modes, out=None):
 
     # Product combining two scattering matrices
-    # s1, s2: Scattering matrices to combine
+    # s1, s2: Scattering matrices to combine (ScatBlocks)
     # n_modes: Number of modes contributing to transport (N_states/2 because spin momentum locking)
+    # out: Optional preallocated ScatBlocks for the scattering matrix (may be s1 or s2)
 
-    if s1.shape != s2.shape:
+    if s1.R.shape != s2.R.shape:
         raise ValueError(" Different size for scattering matrices")
+    if s1.R.shape != (n_modes, n_modes):
+        raise ValueError(" Size of the scattering matrices does not match the number of modes")
+
+    dtype = np.result_type(s1.R, s2.R)
+    s1 = ScatBlocks(*(np.ascontiguousarray(block, dtype=dtype) for block in s1))
+    s2 = ScatBlocks(*(np.ascontiguousarray(block, dtype=dtype) for block in s2))
+    if out is None:
+        out = scat_empty(n_modes, dtype)
+
+    _scat_product(*s1, *s2, *out)
+    return out
+
+@njit(cache=True)
+def _scat_product(r1, t1p, t1, r1p, r2, t2p, t2, r2p, R, Tp, T, Rp):
+
+    # Compiled kernel of scat_product, every block is computed before the output (possibly aliasing s1 or s2) is written
+
+    n_modes = r1.shape[0]
+    A1 = - r1p @ r2               # 1 - r1' r2
+    A2 = - r2 @ r1p               # 1 - r2 r1'
+    for i in range(n_modes):
+        A1[i, i] += 1
+        A2[i, i] += 1
+    aux1 = np.linalg.solve(A1, t1)     # (1 - r1' r2)^(-1) t1
+    aux2 = np.linalg.solve(A2, t2p)    # (1 - r2 r1')^(-1) t2'
+
+    R_new = r1 + t1p @ (r2 @ aux1)     # r
+    Rp_new = r2p + t2 @ (r1p @ aux2)   # r'
+    T[:] = t2 @ aux1                   # t
+    Tp[:] = t1p @ aux2                 # t'
+    R[:] = R_new
+    Rp[:] = Rp_new
+
+def scat_power(s, n, n_modes):
+
+    # Scattering matrix of n identical steps combined, by repeated squaring in O(log n) products
+    # s: Scattering matrix of a single step
+    # n: Number of steps
+    # n_modes: Number of modes contributing to transport (N_states/2 because spin momentum locking)
 
-    r1, r2 = s1[0: n_modes, 0: n_modes], s2[0: n_modes, 0: n_modes]  # r1, r2
-    r1p, r2p = s1[n_modes:, n_modes:], s2[n_modes:, n_modes:]        # r1', r2'
-    t1, t2 = s1[n_modes:, 0: n_modes], s2[n_modes:, 0: n_modes]      # t1, t2
-    t1p, t2p = s1[0: n_modes, n_modes:], s2[0: n_modes, n_modes:]    # t1', t2'
-
-    R = r1 + t1p @ r2 @ inv(np.eye(n_modes) - r1p @ r2) @ t1      # r
-    Rp = r2p + t2 @ r1p @ inv(np.eye(n_modes) - r2 @ r1p) @ t2p   # r'
-    T = t2 @ inv(np.eye(n_modes) - r1p @ r2) @ t1                 # t
-    Tp = t1p @ inv(np.eye(n_modes) - r2 @ r1p) @ t2p              # t'
+    if n < 1:
+        raise ValueError(" Need at least one step to combine")
 
-    scat_matrix = np.block([[R, Tp], [T, Rp]])  # scattering matrix
+    scat_matrix = None
+    while n > 0:
+        if n & 1:
+            scat_matrix = scat_copy(s) if scat_matrix is None else scat_product(scat_matrix, s, n_modes)
+        n >>= 1
+        if n > 0:
+            s = scat_product(s, s, n_modes)
 
     return scat_matrix
 
-def transport_checks(n_modes, transfer_matrix=None, scat_matrix=None):
+def uniform_scattering(transfer_matrix, n, n_modes, transfer_power=False):
+
+    # Scattering matrix of n identical steps from the transfer matrix of a single step
+    # transfer_matrix: Transfer matrix of a single step
+    # n: Number of steps
+    # n_modes: Number of modes contributing to transport (N_states/2 because spin momentum locking)
+    # transfer_power: Take T^n and convert it once instead of combining scattering matrices (opt-in, see below)
+
+    # Combining scattering matrices by repeated squaring is stable. T^n needs a single conversion, but the evanescent
+    # modes grow exponentially with n and can destroy it without producing NaNs, so it is only meant for short or
+    # field free wires where T is well conditioned, and its result is not checked.
+    if transfer_power:
+        return transfer_to_scattering(np.linalg.matrix_power(transfer_matrix, n), n_modes)
+
+    return scat_power(transfer_to_scattering(transfer_matrix, n_modes), n, n_modes)
+
+def scat_empty(n_modes, dtype=complex):
+
+    # Uninitialised scattering matrix buffer
+    # n_modes: Number of modes contributing to transport (N_states/2 because spin momentum locking)
+    # dtype: Complex dtype of the blocks
+
+    return ScatBlocks(*(np.empty((n_modes, n_modes), dtype=dtype) for _ in ScatBlocks._fields))
+
+def scat_copy(s, out=None):
+
+    # Copy of a scattering matrix, into out if given
+    # s: Scattering matrix to copy (ScatBlocks)
+    # out: Optional preallocated ScatBlocks
+
+    if out is None:
+        return ScatBlocks(*(block.copy() for block in s))
+    for block_out, block in zip(out, s):
+        block_out[:] = block
+    return out
+
+@njit(cache=True, fastmath=True)
+def M_EV(modes, dx, dr, E, vf, out):
+
+    # Ef term of the exponent of the transfer matrix, sigma_z x Id, written in place
+    # modes: Angular momentum modes
+    # dx: Transfer step
+    # dr: Slope of the radius at the current point
+    # E: Fermi energy
+    # vf: Fermi velocity
+    # out: Preallocated (2 n_modes, 2 n_modes) complex exponent of the transfer matrix
+
+    n_modes = len(modes)
+    aux = 1j * (E / vf) * np.sqrt(1 + dr ** 2) * dx
+
+    for i in range(n_modes):
+        out[i, i] = aux
+        out[n_modes + i, n_modes + i] = - aux
+
+@njit(cache=True, fastmath=True)
+def M_theta(modes, dx, r, dr, A_par, out):
+
+    # p_y and eA_y terms of the exponent of the transfer matrix, sigma_x x diag, written in place
+    # modes: Angular momentum modes
+    # dx: Transfer step
+    # r: Radius at the current point
+    # dr: Slope of the radius at the current point
+    # A_par: Amplitude of the parallel vector potential (0.5 * 1e16 * e * B_par)
+    # out: Preallocated (2 n_modes, 2 n_modes) complex exponent of the transfer matrix
+
+    n_modes = len(modes)
+    aux = np.sqrt(1 + dr ** 2) * dx
+
+    for i in range(n_modes):
+        out[i, n_modes + i] = aux * (((modes[i] - 0.5) / r) + A_par * r)
+        out[n_modes + i, i] = out[i, n_modes + i]
+
+def ax_coefficients(modes):
+
+    # Lookup table of (-1)^((m+1)/2) / m^2 for the eA_x mode mixing, m = n1 - n2 odd (0 for m even)
+    # modes: Angular momentum modes (consecutive integers)
+    # Returns the table indexed by m + n_modes - 1
+
+    n_modes = len(modes)
+    m = np.arange(-(n_modes - 1), n_modes)
+    odd = m % 2 != 0
+    sign = np.where(((m + 1) // 2) % 2 == 0, 1, -1)  # (-1) ** ((m + 1) / 2)
+    ax_coeff = np.zeros((len(m), ))
+    ax_coeff[odd] = sign[odd] / (m[odd] ** 2)
+
+    return ax_coeff
+
+def ax_matrix(modes, r, C):
+
+    # Mode mixing matrix C (-1)^((m+1)/2) sin(m pi r/2) / (m pi)^2 of the eA_x term, m = n1 - n2 odd (0 for m even)
+    # modes: Angular momentum modes (consecutive integers)
+    # r: Aspect ratio w / (w + h)
+    # C: Amplitude of the mixing (1e16 * e * B_perp * P, times hbar vf in the Hamiltonian)
+    # Returns a read-only array shared between calls with the same arguments
+
+    return _ax_matrix(int(modes[0]), len(modes), float(r), float(C))
+
+@lru_cache(maxsize=1024)
+def _ax_matrix(l_min, n_modes, r, C):
+
+    # Cached ax_matrix, modes frozen to their first value and number so the arguments are hashable
+
+    m_pi, coeff = _ax_tables(l_min, n_modes)
+    ax = C * coeff * np.sin(m_pi * r / 2) / (pi * pi)
+    ax.flags.writeable = False
+
+    return ax
+
+@lru_cache(maxsize=16)
+def _ax_tables(l_min, n_modes):
+
+    # r and C independent part of ax_matrix, (n1 - n2) pi and the coefficient of every pair of modes as float64
+
+    modes = np.arange(l_min, l_min + n_modes)
+    m = np.subtract.outer(modes, modes)
+    m_pi = m * pi
+    coeff = ax_coefficients(modes)[m + n_modes - 1]
+    m_pi.flags.writeable = False
+    coeff.flags.writeable = False
+
+    return m_pi, coeff
+
+@njit(cache=True, fastmath=True)
+def M_Ax(modes, ax, dx, out):
+
+    # eA_x mode mixing term of the exponent of the transfer matrix, sigma_0 x (-i ax), written in place
+    # modes: Angular momentum modes
+    # ax: Mode mixing matrix from ax_matrix(modes, r, A_perp * P)
+    # dx: Transfer step
+    # out: Preallocated (2 n_modes, 2 n_modes) complex exponent of the transfer matrix
+
+    n_modes = len(modes)
+
+    for i in range(n_modes):
+        for j in range(n_modes):
+            if (modes[i] - modes[j]) & 1:
+                out[i, j] = - 1j * dx * ax[i, j]
+                out[n_modes + i, n_modes + j] = out[i, j]
+
+@njit(cache=True, fastmath=True)
+def build_M(modes, dx, r, dr, E, vf, A_par, ax, update_ax, out):
+
+    # Exponent of the transfer matrix for one step, all four n_modes x n_modes blocks written in place
+    # modes: Angular momentum modes
+    # dx: Transfer step
+    # r, dr: Radius and slope of the radius at the current point
+    # E: Fermi energy
+    # vf: Fermi velocity
+    # A_par: Amplitude of the parallel vector potential (0.5 * 1e16 * e * B_par)
+    # ax: Mode mixing matrix from ax_matrix(modes, w / (w + h), A_perp * P) at the current point
+    # update_ax: False if ax is unchanged since the last call on out, so the eA_x entries can be kept
+    # out: Preallocated (2 n_modes, 2 n_modes) complex exponent of the transfer matrix
+
+    M_EV(modes, dx, dr, E, vf, out)              # Diagonal of the sigma_z blocks
+    M_theta(modes, dx, r, dr, A_par, out)        # Diagonal of the sigma_x blocks
+    if update_ax:
+        M_Ax(modes, ax, dx, out)                 # Off-diagonal of the sigma_0 blocks
+
+def constriction_regions(x, x1, x2, x3, x4):
+
+    # Regions of a symmetric constriction along x, computed once and shared by all its profiles
+    # x: Positions along the wire
+    # x1, x2: Start and end of the first cone
+    # x3, x4: Start and end of the second cone
+    # Returns the masks of the first cone, the constriction and the second cone (the leads are the rest)
+
+    x = np.asarray(x)
+    return (x1 <= x) & (x <= x2), (x2 < x) & (x < x3), (x3 <= x) & (x <= x4)
+
+def constriction_profile(x, regions, x1, x3, v1, v2, slope):
+
+    # Piecewise linear profile (width, height, radius...) of a symmetric constriction
+    # x: Positions along the wire
+    # regions: Masks from constriction_regions for the same positions
+    # x1, x3: Start of the first and second cones
+    # v1, v2: Value of the profile in the leads and in the constriction
+    # slope: Slope of the profile in the first cone
+
+    x = np.asarray(x)
+    cone_in, constriction, cone_out = regions
+    profile = np.full(x.shape, v1, dtype=float)
+    profile[cone_in] = v1 + slope * (x[cone_in] - x1)
+    profile[constriction] = v2
+    profile[cone_out] = v2 - slope * (x[cone_out] - x3)
+
+    return profile
+
+def pair_steps(dx, dr_grid, profiles, tol):
+
+    # Merge consecutive steps where the geometry varies into single midpoint steps of length 2 dx
+    # dx: Transfer step
+    # dr_grid: Slope of the radius along the grid
+    # profiles: Tuple of other geometric quantities along the grid (width, height, radius...)
+    # tol: Maximum change of the slope between two steps that are merged (negative to disable the merging)
+    # Returns the step lengths, slopes and profiles on the merged grid
+
+    # exp(2 dx M(x + dx/2)) agrees with exp(dx M(x + dx)) exp(dx M(x)) up to O(dx^3), the same as the midpoint rule.
+    # Uniform regions are left alone since their steps are already reused.
+    n_x = len(dr_grid)
+    first, last = [], []
+    j = 0
+    while j < n_x:
+        varying = j + 1 < n_x and any(p[j] != p[j + 1] for p in profiles)
+        if varying and abs(dr_grid[j + 1] - dr_grid[j]) <= tol:
+            first.append(j)
+            last.append(j + 1)
+            j += 2
+        else:
+            first.append(j)
+            last.append(j)
+            j += 1
+    first, last = np.array(first), np.array(last)
+
+    dx_grid = dx * (last - first + 1)
+    dr_grid = (dr_grid[first] + dr_grid[last]) / 2
+    profiles = tuple((p[first] + p[last]) / 2 for p in profiles)
+
+    return dx_grid, dr_grid, profiles
+
+def expm_block(M, n_modes):
+
+    # Exponential of the exponent of the transfer matrix exploiting its sigma_z / sigma_x block structure
+    # M: Exponent of the transfer matrix (complex128 or complex64, kept in the result), or a stack of them (..., 2N, 2N)
+    # n_modes: Number of modes contributing to transport (N_states/2 because spin momentum locking)
+
+    # Without mode mixing all four blocks are diagonal and M is a direct sum of 2x2 blocks [[a, b], [c, d]], each
+    # with exponential exp(mu) (cosh(q) Id + sinh(q)/q (K - mu Id)), mu = (a+d)/2, q^2 = ((a-d)/2)^2 + bc.
+    # With mode mixing the blocks do not commute and we fall back to the Pade approximant.
+    for block in (M[..., 0: n_modes, 0: n_modes], M[..., 0: n_modes, n_modes:], M[..., n_modes:, 0: n_modes],
+                  M[..., n_modes:, n_modes:]):
+        if np.count_nonzero(block) != np.count_nonzero(np.diagonal(block, axis1=-2, axis2=-1)):
+            return expm(M)
+
+    a = np.diagonal(M[..., 0: n_modes, 0: n_modes], axis1=-2, axis2=-1)
+    b = np.diagonal(M[..., 0: n_modes, n_modes:], axis1=-2, axis2=-1)
+    c = np.diagonal(M[..., n_modes:, 0: n_modes], axis1=-2, axis2=-1)
+    d = np.diagonal(M[..., n_modes:, n_modes:], axis1=-2, axis2=-1)
+    mu, delta = (a + d) / 2, (a - d) / 2
+    q = np.sqrt(delta ** 2 + b * c + 0j)
+    aux = np.exp(mu)
+    ch, sh = aux * np.cosh(q), aux * np.sinc(1j * q / pi)  # sinc(iq/pi) = sinh(q)/q, finite at q = 0
+
+    idx = np.arange(n_modes)
+    transfer_matrix = np.zeros(M.shape, dtype=M.dtype)
+    transfer_matrix[..., idx, idx] = ch + sh * delta
+    transfer_matrix[..., idx, n_modes + idx] = sh * b
+    transfer_matrix[..., n_modes + idx, idx] = sh * c
+    transfer_matrix[..., n_modes + idx, n_modes + idx] = ch - sh * delta
+
+    return transfer_matrix
+
+def transfer_sweep(M_0, energies, c, n_modes):
+
+    # Transfer matrices of one step for a sweep of Fermi energies, M(E) = M_0 + i E c sigma_z x Id
+    # M_0: Exponent of the transfer matrix at E = 0 (build_M with E = 0)
+    # energies: Fermi energies of the sweep
+    # c: sqrt(1 + dr^2) dx / vf at the step
+    # n_modes: Number of modes contributing to transport (N_states/2 because spin momentum locking)
+    # Returns the (len(energies), 2 n_modes, 2 n_modes) stack of transfer matrices
+
+    # sigma_z x Id anticommutes with the sigma_x terms of M_0, so exp(M_0) cannot be reused for other energies. The
+    # energy independent part is built once and the exponentials are taken on the whole stack in one call.
+    sign = np.concatenate((np.ones(n_modes), -np.ones(n_modes)))   # Diagonal of sigma_z x Id
+    idx = np.arange(2 * n_modes)
+    M = np.repeat(M_0[np.newaxis], len(energies), axis=0)
+    M[:, idx, idx] += 1j * c * np.outer(energies, sign)
+
+    return expm_block(M, n_modes)
+
+@njit(parallel=True, cache=True)
+def bands_nw(H_static, k_range, vf):
+
+    # Energy bands of a uniform nanowire, each momentum diagonalised independently in parallel
+    # H_static: k independent part of the Hamiltonian in the (modes x spin) tensor product basis
+    # k_range: Momentum grid
+    # vf: Fermi velocity (times hbar)
+    # Returns the (2 n_modes, len(k_range)) array of ordered energies
+
+    n_states = H_static.shape[0]
+    energy = np.zeros((n_states, len(k_range)))
+
+    for ik in prange(len(k_range)):
+        H = H_static.copy()                   # H(k) = vf k sigma_x + H_static, local to each thread
+        for i in range(0, n_states, 2):
+            H[i, i + 1] += vf * k_range[ik]
+            H[i + 1, i] += vf * k_range[ik]
+        energy[:, ik] = np.linalg.eigvalsh(H)  # Eigenvalues come out in ascending order
+
+    return energy
+
+def transport_checks(n_modes, transfer_matrix=None, scat_matrix=None, tol=1e-8, verbose=True):
 
     # Check the conservation of current and the unitarity condition for transfer/scattering matrices
     # n_modes: Number of modes contributing to transport (N_states/2 because spin momentum locking)
+    # transfer_matrix, scat_matrix: Transfer matrix and scattering matrix (ScatBlocks) to check
+    # tol: Absolute tolerance of the checks (loosen it for complex64 matrices)
+    # verbose: Print the result of each check
+    # Returns True if all requested checks pass
 
-    sigma_z = np.array([[1, 0], [0, -1]])  # Pauli z
+    identity = np.eye(n_modes)
+    checks = []
 
-    # Conservation of the current
+    # Conservation of the current, T sigma_z T^\dagger = sigma_z block by block
     if transfer_matrix is not None:
-        check1 = transfer_matrix @ np.kron(sigma_z, np.eye(n_modes)) @ np.conj(transfer_matrix.T)
-        print(np.allclose(np.kron(sigma_z, np.eye(n_modes)), check1))
-
-    # Unitarity of the scattering matrix
+        sign = np.concatenate((np.ones(n_modes), -np.ones(n_modes)))   # Diagonal of sigma_z
+        top, bottom = transfer_matrix[0: n_modes, :], transfer_matrix[n_modes:, :]
+        top_z = top * sign                                              # Rows of T sigma_z
+        bottom_z = bottom * sign
+        checks.append(np.allclose(identity, top_z @ np.conj(top.T), atol=tol) and
+                      np.allclose(-identity, bottom_z @ np.conj(bottom.T), atol=tol) and
+                      np.allclose(0, top_z @ np.conj(bottom.T), atol=tol))
+
+    # Unitarity of the scattering matrix, S S^\dagger = 1 block by block
     if scat_matrix is not None:
-        check2 = scat_matrix @ np.conj(scat_matrix.T)
-        print(np.allclose(np.eye(2 * n_modes), check2))
+        R, Tp, T, Rp = scat_matrix
+        checks.append(np.allclose(identity, R @ np.conj(R.T) + Tp @ np.conj(Tp.T), atol=tol) and
+                      np.allclose(identity, T @ np.conj(T.T) + Rp @ np.conj(Rp.T), atol=tol) and
+                      np.allclose(0, R @ np.conj(T.T) + Tp @ np.conj(Rp.T), atol=tol))
 
-    # Completeness of reflection and transmission
+    # Completeness of reflection and transmission, Tr(r^\dagger r) + Tr(t^\dagger t) = n_modes
     if scat_matrix is not None:
-        t, r = scat_matrix[n_modes:, 0: n_modes], scat_matrix[0: n_modes, 0: n_modes]
-        t_dagger, r_dagger = np.conj(t.T), np.conj(r.T)
-        print(np.allclose(n_modes-np.trace(r_dagger @ r), np.trace(t_dagger @ t)))
+        checks.append(np.allclose(n_modes - np.linalg.norm(R) ** 2, np.linalg.norm(T) ** 2, atol=tol))
+
+    if verbose:
+        for check in checks:
+            print(check)
+
+    return all(checks)
 
 def thermal_average(T, mu, E, G):
 